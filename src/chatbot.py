@@ -8,6 +8,16 @@ from dotenv import load_dotenv
 from tempfile import NamedTemporaryFile
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 import re
+import hashlib
+import heapq
+import math
+import threading
+import unicodedata
+import uuid
+from concurrent.futures import Future
+from collections import Counter, defaultdict
+from typing import List, Optional, get_args
+from pydantic import BaseModel, Field, create_model
 from langchain.document_loaders import PyPDFium2Loader as PyPDFLoader
 
 # Cargar variables desde el archivo .env
@@ -67,31 +77,154 @@ def create_word_document_with_clean_formatting(response_text):
     if table_lines:
         add_table_to_document(doc, table_lines)
 
-    # Guardar el documento
-    doc_path = "resumen_generado.docx"
+    # Guardar el documento en un archivo propio de la llamada (varias sesiones pueden exportar a la vez)
+    doc_path = save_word_document(doc)
+    return doc_path
+
+def save_word_document(doc):
+    """Guarda el documento en un archivo temporal único y devuelve su ruta."""
+    with NamedTemporaryFile(delete=False, suffix=".docx") as temp_file:
+        doc_path = temp_file.name
     doc.save(doc_path)
     return doc_path
 
 def add_table_to_document(doc, table_lines):
     """Convierte líneas con formato de tabla en una tabla legible dentro del documento Word."""
     rows = [line.strip("|").split("|") for line in table_lines]
-    table = doc.add_table(rows=1, cols=len(rows[0]))
+    add_data_table(doc, rows[0], rows[1:])
+
+def add_data_table(doc, headers, rows):
+    """Agrega al documento Word una tabla con encabezados y filas ya estructurados."""
+    table = doc.add_table(rows=1, cols=len(headers))
     table.style = "Table Grid"
 
     # Encabezados de la tabla
     header_cells = table.rows[0].cells
-    for i, header in enumerate(rows[0]):
+    for i, header in enumerate(headers):
         header_cells[i].text = clean_text(header.strip())
         header_cells[i].paragraphs[0].runs[0].font.bold = True
         header_cells[i].paragraphs[0].runs[0].font.size = Pt(11)
         header_cells[i].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
 
     # Filas de datos
-    for row in rows[1:]:
+    for row in rows:
         cells = table.add_row().cells
         for i, cell in enumerate(row):
             cells[i].text = clean_text(cell.strip())
 
+# Esquema tipado de los campos del PCAP para el modo de extracción estructurada
+class TipoContrato(BaseModel):
+    """Tipo y objeto del contrato."""
+    tipo: Optional[str] = Field(None, title="Tipo de contrato", description="Servicio, suministro u otro tipo de contrato")
+    subtipo: Optional[str] = Field(None, title="Tipo de suministro / servicio", description="Tipo específico de suministro o servicio requerido")
+    objeto: Optional[str] = Field(None, title="Objeto del contrato", description="Objeto y alcance del contrato")
+
+class Lote(BaseModel):
+    """Importe máximo de licitación de un lote."""
+    lote: Optional[str] = Field(None, title="Lote", description="Número o nombre del lote")
+    descripcion: Optional[str] = Field(None, title="Descripción", description="Descripción breve del lote")
+    importe_sin_iva: Optional[float] = Field(None, title="Importe máximo sin IVA (€)", description="Importe máximo de licitación del lote sin IVA, en euros")
+
+class ImportesLotes(BaseModel):
+    """Importes máximos de licitación por lote."""
+    lotes: List[Lote] = Field(default_factory=list, description="Lotes del contrato; un único elemento si no hay división en lotes")
+
+class Presupuesto(BaseModel):
+    """Presupuesto y valor estimado del contrato."""
+    base_sin_iva: Optional[float] = Field(None, title="Presupuesto base sin IVA (€)", description="Presupuesto base de licitación sin IVA, en euros")
+    base_con_iva: Optional[float] = Field(None, title="Presupuesto base con IVA (€)", description="Presupuesto base de licitación con IVA, en euros")
+    valor_estimado: Optional[float] = Field(None, title="Valor estimado (€)", description="Valor estimado del contrato incluyendo prórrogas y modificaciones, en euros")
+    observaciones: Optional[str] = Field(None, title="Observaciones", description="Aclaraciones sobre anualidades, prórrogas o IVA aplicable")
+
+class Criterio(BaseModel):
+    """Criterio de adjudicación y su ponderación."""
+    criterio: Optional[str] = Field(None, title="Criterio", description="Nombre del criterio de adjudicación")
+    tipo: Optional[str] = Field(None, title="Tipo", description="'Objetivo' si se valora mediante fórmula, 'Subjetivo' si es un juicio de valor")
+    ponderacion: Optional[float] = Field(None, title="Ponderación (puntos)", description="Puntuación máxima o peso del criterio")
+
+class CriteriosAdjudicacion(BaseModel):
+    """Criterios de adjudicación con sus pesos."""
+    criterios: List[Criterio] = Field(default_factory=list, description="Todos los criterios de adjudicación del pliego")
+
+class FormulaPrecio(BaseModel):
+    """Fórmula de valoración del precio."""
+    formula: Optional[str] = Field(None, title="Fórmula", description="Fórmula matemática literal para puntuar la oferta económica")
+    explicacion: Optional[str] = Field(None, title="Explicación", description="Explicación de las variables de la fórmula y umbrales de baja anormal")
+
+class Garantias(BaseModel):
+    """Garantías exigidas."""
+    provisional: Optional[str] = Field(None, title="Garantía provisional", description="Importe o porcentaje y condiciones de la garantía provisional, o si no se exige")
+    definitiva: Optional[str] = Field(None, title="Garantía definitiva", description="Importe o porcentaje, plazo y condiciones de la garantía definitiva")
+
+class Plazo(BaseModel):
+    """Plazo relevante del contrato."""
+    concepto: Optional[str] = Field(None, title="Concepto", description="Ejecución, entrega, presentación de ofertas, prórroga, garantía, etc.")
+    plazo: Optional[str] = Field(None, title="Plazo", description="Duración o fecha tal como figura en el pliego")
+
+class Plazos(BaseModel):
+    """Plazos del contrato."""
+    plazos: List[Plazo] = Field(default_factory=list, description="Plazos de ejecución, entrega, presentación de ofertas y prórrogas")
+
+# Campos extraídos en el modo estructurado: clave -> (título, esquema)
+PCAP_FIELDS = {
+    "tipo_contrato": ("Tipo de contrato", TipoContrato),
+    "lotes": ("Importes máximos de licitación por lote", ImportesLotes),
+    "presupuesto": ("Presupuesto del contrato", Presupuesto),
+    "criterios_adjudicacion": ("Criterios de adjudicación", CriteriosAdjudicacion),
+    "formula_precio": ("Fórmula del precio", FormulaPrecio),
+    "garantias": ("Garantías", Garantias),
+    "plazos": ("Plazos", Plazos),
+}
+
+# Esquema combinado para extraer todos los campos en una sola llamada por chunk
+PCAPDatos = create_model(
+    "PCAPDatos",
+    **{field: (schema, Field(default_factory=schema, description=title)) for field, (title, schema) in PCAP_FIELDS.items()},
+)
+
+def format_pcap_value(value):
+    """Convierte un valor extraído en texto legible para tablas."""
+    if value is None or value == "":
+        return "No indicado"
+    if isinstance(value, float):
+        # Formato numérico español: 1.234,56
+        return f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    return str(value)
+
+def pcap_field_table(field, value):
+    """Devuelve los encabezados y filas de la tabla de un campo PCAP extraído."""
+    schema = PCAP_FIELDS[field][1]
+    if len(schema.model_fields) == 1:
+        # Campos de lista: una fila por elemento
+        name, info = next(iter(schema.model_fields.items()))
+        item_schema = get_args(info.annotation)[0]
+        headers = [item_info.title for item_info in item_schema.model_fields.values()]
+        rows = [
+            [format_pcap_value(item.get(item_name)) for item_name in item_schema.model_fields]
+            for item in value.get(name, [])
+        ]
+    else:
+        headers = ["Campo", "Valor"]
+        rows = [[info.title, format_pcap_value(value.get(name))] for name, info in schema.model_fields.items()]
+    return headers, rows
+
+# Crear documento Word a partir de los datos estructurados del PCAP
+def create_word_document_from_pcap_data(pcap_data):
+    """Crea un archivo Word con una tabla por cada campo PCAP extraído."""
+    doc = Document()
+    doc.add_heading("Resumen generado por Solutia", level=1)
+
+    for field, (title, _) in PCAP_FIELDS.items():
+        add_section_header(doc, title)
+        value = pcap_data.get(field)
+        headers, rows = pcap_field_table(field, value) if value else ([], [])
+        if rows:
+            add_data_table(doc, headers, rows)
+        else:
+            doc.add_paragraph().add_run("No se encontró información en el documento.").font.size = Pt(11)
+
+    doc_path = save_word_document(doc)
+    return doc_path
 
 # Configuración del modelo
 llm = ChatOpenAI(
@@ -106,6 +239,24 @@ if "processed_files" not in st.session_state:
 if "processed_summaries" not in st.session_state:
     st.session_state.processed_summaries = {"ppt": None, "pcap": None}
 
+# Datos estructurados del PCAP
+if "processed_data" not in st.session_state:
+    st.session_state.processed_data = {"pcap": None}
+
+# Nonces únicos por pulsación: la caché es compartida por todas las sesiones del servidor
+if "pcap_field_nonces" not in st.session_state:
+    st.session_state.pcap_field_nonces = dict.fromkeys(PCAP_FIELDS)
+    st.session_state.pcap_document_nonce = None
+    st.session_state.pcap_extraction_error = None
+
+# Estadísticas de la fase map del último resumen de cada documento
+if "summary_stats" not in st.session_state:
+    st.session_state.summary_stats = {"ppt": None, "pcap": None}
+
+# Historial del chat de preguntas sobre los pliegos
+if "chat_history" not in st.session_state:
+    st.session_state.chat_history = []
+
 # Agregar nuevo estado para el último tipo de documento procesado
 if "last_processed" not in st.session_state:
     st.session_state.last_processed = None
@@ -114,6 +265,9 @@ if "last_processed" not in st.session_state:
 if "display_order" not in st.session_state:
     st.session_state.display_order = []
 
+# Separador entre páginas en el texto extraído (split() lo trata como espacio)
+PAGE_SEPARATOR = "\f"
+
 # Función para extraer texto del PDF
 def extract_text_with_langchain(uploaded_file):
     """Extrae texto de un archivo PDF utilizando LangChain PyPDFLoader."""
@@ -124,13 +278,76 @@ def extract_text_with_langchain(uploaded_file):
     try:
         loader = PyPDFLoader(temp_file_path)
         documents = loader.load()
-        text = "\n".join([doc.page_content for doc in documents])
+        text = PAGE_SEPARATOR.join([doc.page_content for doc in documents])
         if not text.strip():
             st.error(f"El archivo {uploaded_file.name} no contiene texto o no pudo ser leído.")
         return text
     finally:
         os.remove(temp_file_path)
 
+# Extracción local de cifras clave para la vista previa
+# Miles con punto, espacio o espacio duro; el límite izquierdo evita capturar la cola de otra cifra
+AMOUNT_PATTERN = re.compile(
+    r"(?<![\d.,])(?:\d{1,3}(?:[. \u00a0\u202f]\d{3})+|\d+)(?:,\d{1,2})?\s?(?:€|(?:de\s+)?euros?\b|EUR\b)",
+    re.IGNORECASE,
+)
+PERCENT_PATTERN = re.compile(r"\d{1,3}(?:,\d{1,2})?\s?(?:%|por\s+ciento)", re.IGNORECASE)
+DEADLINE_PATTERN = re.compile(
+    r"\b(?:\d{1,4}|un|una|dos|tres|cuatro|cinco|seis|doce|quince|veinte|treinta)\s+"
+    r"(?:d[ií]as|mes(?:es)?|a[ñn]os?|semanas|horas)(?:\s+(?:h[aá]biles|naturales))?"
+    r"|\d{1,2}/\d{1,2}/\d{2,4}"
+    r"|\d{1,2}\s+de\s+(?:enero|febrero|marzo|abril|mayo|junio|julio|agosto|septiembre|octubre|noviembre|diciembre)\s+de\s+\d{4}",
+    re.IGNORECASE,
+)
+KEY_FIGURES = [
+    ("Presupuesto base de licitación", re.compile(r"presupuesto\s+base\s+de\s+licitaci[oó]n", re.IGNORECASE), (AMOUNT_PATTERN,)),
+    ("Valor estimado", re.compile(r"valor\s+estimado", re.IGNORECASE), (AMOUNT_PATTERN,)),
+    ("Garantía provisional", re.compile(r"garant[ií]a\s+provisional", re.IGNORECASE), (PERCENT_PATTERN, AMOUNT_PATTERN)),
+    ("Garantía definitiva", re.compile(r"garant[ií]a\s+definitiva", re.IGNORECASE), (PERCENT_PATTERN, AMOUNT_PATTERN)),
+    ("Plazo de ejecución", re.compile(r"plazo\s+de\s+(?:ejecuci[oó]n|duraci[oó]n)|duraci[oó]n\s+del\s+contrato", re.IGNORECASE), (DEADLINE_PATTERN,)),
+    ("Plazo de presentación de ofertas", re.compile(r"plazo\s+de\s+presentaci[oó]n", re.IGNORECASE), (DEADLINE_PATTERN,)),
+    ("Prórroga", re.compile(r"pr[oó]rrogas?", re.IGNORECASE), (DEADLINE_PATTERN,)),
+    ("Plazo de garantía", re.compile(r"plazo\s+de\s+garant[ií]a", re.IGNORECASE), (DEADLINE_PATTERN,)),
+]
+KEY_FIGURE_WINDOW = 300
+KEY_FIGURE_MAX_ROWS = 3
+
+def extract_key_figures(text):
+    """Localiza importes, porcentajes y plazos cercanos a conceptos clave, con su número de página."""
+    rows = []
+    seen = set()
+    counts = Counter()
+    for page_number, page in enumerate(text.split(PAGE_SEPARATOR), start=1):
+        for label, keyword, value_patterns in KEY_FIGURES:
+            for match in keyword.finditer(page):
+                if counts[label] >= KEY_FIGURE_MAX_ROWS:
+                    break
+                # Tomar el valor más próximo que aparezca tras el concepto
+                window = page[match.end():match.end() + KEY_FIGURE_WINDOW]
+                candidates = [found for pattern in value_patterns if (found := pattern.search(window))]
+                if not candidates:
+                    continue
+                value = " ".join(min(candidates, key=lambda found: found.start()).group().split())
+                if (label, value) in seen:
+                    continue
+                seen.add((label, value))
+                counts[label] += 1
+                rows.append({"Concepto": label, "Valor": value, "Página": page_number})
+    return rows
+
+def show_key_figures_preview(placeholder, text):
+    """Muestra en el contenedor indicado la vista previa de cifras clave del documento."""
+    rows = extract_key_figures(text)
+    if rows:
+        with placeholder.container():
+            st.markdown("#### Vista previa de cifras clave")
+            st.caption("Extracción local preliminar; se sustituirá por el resumen completo cuando esté listo.")
+            st.table(rows)
+
+def document_hash(text):
+    """Identificador estable del contenido de un documento, usado como clave de caché."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
 # Procesar texto del documento completo
 def split_text(text, max_chunk_size=50000):
     """Divide el texto en chunks más pequeños."""
@@ -155,14 +372,7 @@ def split_text(text, max_chunk_size=50000):
     
     return chunks
 
-def process_full_document(text, model, task="Resumen del documento"):
-    """Procesa todo el texto del documento y genera un resumen profesional y limpio."""
-    # Dividir el texto en chunks más pequeños
-    chunks = split_text(text)
-    summaries = []
-    
-    system_message = SystemMessage(
-        content="""Eres un chatbot AI útil, te llamas Solutia, tienes que hablar como si fueras un asistente, nunca reveles que eres un chatbot.
+SUMMARY_SYSTEM_PROMPT = """Eres un chatbot AI útil, te llamas Solutia, tienes que hablar como si fueras un asistente, nunca reveles que eres un chatbot.
 Rol
 Eres un experto en análisis de documentos técnicos y generación de resúmenes estructurados para licitaciones públicas. Tienes años de experiencia analizando pliegos de prescripciones técnicas (PPT) y pliegos de cláusulas administrativas particulares (PCAP) de concursos públicos. Posees habilidades avanzadas para extraer y sintetizar la información más relevante de estos documentos, asegurando que los responsables de buscar licitaciones puedan tomar decisiones rápidamente.
 
@@ -253,8 +463,106 @@ Notas Adicionales:
 Si algún parámetro clave no aparece en los documentos, debes indicarlo claramente en los resúmenes con una nota específica y referencia a la LCSP o normativas aplicables.
 Garantiza que el resumen sea profesional, claro y adecuado para uso interno en la empresa.
 Si algún criterio necesita ampliarse, añade ejemplos hipotéticos para hacerlo más claro."""
-    )
+
+# Fase map: notas compactas por chunk que el resumen final convierte en el entregable
+MAP_SYSTEM_PROMPT = """Eres un analista de pliegos de licitaciones públicas (PPT y PCAP).
+Del fragmento recibido, anota solo los datos necesarios para el resumen final: tipo y objeto del contrato, lotes e importes, presupuesto y valor estimado, solvencia, criterios de adjudicación y sus pesos, fórmula del precio, garantías, plazos, prórrogas, ANS, penalizaciones, condiciones y lugar de presentación de ofertas.
+Formato estricto, una nota por línea:
+campo | valor | p. N
+Usa valores literales y breves (cifras, porcentajes, fechas, fórmulas). La página N es el último marcador [p. N] anterior al dato.
+No escribas introducciones, tablas Markdown, explicaciones ni campos sin dato. No repitas notas."""
+MAP_MAX_TOKENS = 800
+# La tercera columna solo se toma como páginas si es una referencia real (p. 3, pág. 4-5, páginas 3 y 7)
+NOTE_PATTERN = re.compile(
+    r"^\s*[-*]?\s*(?P<campo>[^|]+?)\s*\|\s*(?P<valor>.+?)"
+    r"(?:\s*\|\s*(?P<paginas>p(?:[áa]g(?:ina)?s?)?\.?\s*\d[\d,\s\-–y]*))?\s*$",
+    re.IGNORECASE,
+)
+
+def annotate_pages(text):
+    """Inserta marcadores [p. N] al inicio de cada página para que las notas citen su página."""
+    return " ".join(f"[p. {number}] {page}" for number, page in enumerate(text.split(PAGE_SEPARATOR), start=1))
+
+def split_document(text):
+    """Divide el documento en los chunks que se envían al modelo."""
+    return split_text(annotate_pages(text))
+
+def estimate_tokens(text):
+    """Estimación aproximada de tokens: 4 caracteres = 1 token."""
+    return len(text) // 4
+
+def normalize_note(text):
+    """Clave de comparación de notas: minúsculas, sin tildes y con espacios colapsados; conserva símbolos."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return " ".join("".join(char for char in text if not unicodedata.combining(char)).split())
+
+def deduplicate_notes(map_outputs):
+    """Une las notas de todos los chunks eliminando repetidas y agrupando sus páginas.
+
+    Las líneas que no siguen el formato campo | valor | página se conservan literalmente
+    (sin duplicados) para no perder datos. Devuelve el texto de las notas y cuántas líneas
+    no tenían formato.
+    """
+    notes = {}
+    unformatted = {}
+    for output in map_outputs:
+        for line in output.splitlines():
+            match = NOTE_PATTERN.match(line)
+            if not match:
+                if line.strip():
+                    unformatted.setdefault(normalize_note(line), line.strip())
+                continue
+            key = (normalize_note(match["campo"]), normalize_note(match["valor"]))
+            note = notes.setdefault(key, {"campo": match["campo"], "valor": match["valor"], "paginas": []})
+            for page in re.findall(r"\d+(?:\s*[-–]\s*\d+)?", match["paginas"] or ""):
+                page = re.sub(r"\s*[-–]\s*", "-", page)
+                if page not in note["paginas"]:
+                    note["paginas"].append(page)
+    lines = [
+        f"{note['campo']} | {note['valor']} | p. {', '.join(note['paginas']) or '?'}" for note in notes.values()
+    ]
+    return "\n".join(lines + list(unformatted.values())), len(unformatted)
+
+def process_full_document(text, model, task="Resumen del documento", compact_notes=True, stats=None):
+    """Procesa todo el texto del documento y genera un resumen profesional y limpio.
+
+    Con compact_notes, cada chunk produce notas breves (campo | valor | página) con un límite de
+    tokens de salida y solo el resumen final usa el prompt completo. Si se pasa un dict en stats,
+    se rellena con los tamaños estimados de cada fase.
+    """
+    # Dividir el texto en chunks más pequeños
+    chunks = split_document(text)
+    summaries = []
+    
+    system_message = SystemMessage(content=SUMMARY_SYSTEM_PROMPT)
     try:
+        if compact_notes and len(chunks) > 1:
+            # Fase map con prompt breve y salida limitada
+            map_message = SystemMessage(content=MAP_SYSTEM_PROMPT)
+            map_model = model.bind(max_tokens=MAP_MAX_TOKENS)
+            for i, chunk in enumerate(chunks):
+                user_message = HumanMessage(
+                    content=f"Tarea: notas para {task} (Parte {i+1}/{len(chunks)})\n\nTexto del documento:\n{chunk}"
+                )
+                response = map_model.invoke([map_message, user_message])
+                summaries.append(response.content.strip())
+
+            notes, unformatted_notes = deduplicate_notes(summaries)
+            user_message = HumanMessage(
+                content=f"Tarea: {task}. Genera el entregable final a partir de las siguientes notas extraídas del documento completo (campo | valor | páginas):\n\n{notes}"
+            )
+            if stats is not None:
+                stats.update({
+                    "chunks": len(chunks),
+                    "map_output_tokens": sum(estimate_tokens(summary) for summary in summaries),
+                    "map_budget_tokens": len(chunks) * MAP_MAX_TOKENS,
+                    "notes_tokens": estimate_tokens(notes),
+                    "unformatted_notes": unformatted_notes,
+                    "reduce_input_tokens": estimate_tokens(SUMMARY_SYSTEM_PROMPT) + estimate_tokens(user_message.content),
+                })
+            final_response = model([system_message, user_message])
+            return final_response.content.strip()
+
         # Procesar cada chunk por separado
         for i, chunk in enumerate(chunks):
             chunk_task = f"{task} (Parte {i+1}/{len(chunks)})"
@@ -269,6 +577,15 @@ Si algún criterio necesita ampliarse, añade ejemplos hipotéticos para hacerlo
             user_message = HumanMessage(
                 content=f"Tarea: Generar resumen final combinando los siguientes resúmenes parciales:\n\n{final_summary_text}"
             )
+            if stats is not None:
+                stats.update({
+                    "chunks": len(chunks),
+                    "map_output_tokens": estimate_tokens(final_summary_text),
+                    "map_budget_tokens": None,
+                    "notes_tokens": estimate_tokens(final_summary_text),
+                    "unformatted_notes": 0,
+                    "reduce_input_tokens": estimate_tokens(SUMMARY_SYSTEM_PROMPT) + estimate_tokens(user_message.content),
+                })
             final_response = model([system_message, user_message])
             return final_response.content.strip()
         
@@ -278,6 +595,232 @@ Si algún criterio necesita ampliarse, añade ejemplos hipotéticos para hacerlo
         st.error(f"Error al generar el resumen: {str(e)}")
         return "Error al generar el resumen."
 
+class SingleFlight:
+    """Agrupa trabajos idénticos en curso para que solo uno de ellos llame al modelo."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.jobs_started = 0
+        self.jobs_joined = 0
+        self.calls_saved = 0
+
+    def run(self, key, job, calls=1):
+        """Ejecuta job() o, si ya hay uno en curso con la misma clave, espera a su resultado."""
+        while True:
+            with self.lock:
+                flight = self.in_flight.get(key)
+                is_leader = flight is None
+                if is_leader:
+                    flight = self.in_flight[key] = Future()
+                    self.jobs_started += 1
+                else:
+                    self.jobs_joined += 1
+                    self.calls_saved += calls
+            if is_leader:
+                try:
+                    flight.set_result(job())
+                except BaseException as e:
+                    # También RerunException/StopException de Streamlit: sin esto los seguidores esperarían siempre
+                    flight.set_exception(e)
+                    raise
+                finally:
+                    with self.lock:
+                        del self.in_flight[key]
+                return flight.result()
+            try:
+                return flight.result()
+            except BaseException as e:
+                if isinstance(e, Exception):
+                    raise
+                # La sesión líder se interrumpió (rerun o parada): repetir el trabajo sin contarlo como ahorro
+                with self.lock:
+                    self.jobs_joined -= 1
+                    self.calls_saved -= calls
+
+@st.cache_resource
+def get_summary_flights():
+    """Registro de resúmenes en curso compartido por todas las sesiones del servidor."""
+    return SingleFlight()
+
+def summarize_document(text, model, task="Resumen del documento", compact_notes=True):
+    """Genera el resumen del documento, uniéndose a un trabajo idéntico si ya está en curso.
+
+    Devuelve el resumen y las estadísticas de la fase map del trabajo que lo generó.
+    """
+    map_prompt = MAP_SYSTEM_PROMPT if compact_notes else ""
+    prompt = f"{getattr(model, 'model_name', '')}\n{task}\n{SUMMARY_SYSTEM_PROMPT}\n{map_prompt}"
+    key = (document_hash(text), hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+    chunks = len(split_document(text))
+    calls = chunks + 1 if chunks > 1 else chunks
+
+    def job():
+        stats = {}
+        summary = process_full_document(text, model, task=task, compact_notes=compact_notes, stats=stats)
+        return summary, stats
+
+    return get_summary_flights().run(key, job, calls)
+
+def merge_field_values(current, new):
+    """Combina el valor de un campo extraído de varios chunks sin sobrescribir datos ya encontrados."""
+    if current is None:
+        return new
+    merged = current.model_dump()
+    for name, value in new.model_dump().items():
+        if isinstance(value, list):
+            merged[name] = merged[name] + [item for item in value if item not in merged[name]]
+        elif merged[name] in (None, ""):
+            merged[name] = value
+    return type(current)(**merged)
+
+PCAP_EXTRACTION_PROMPT = """Eres un experto en pliegos de cláusulas administrativas particulares (PCAP) de licitaciones públicas.
+Extrae {campos} del fragmento del PCAP que se te proporciona.
+Copia los datos tal como aparecen en el pliego. Expresa los importes en euros como números.
+Si un dato no aparece en el fragmento, deja el valor vacío; nunca lo inventes."""
+
+# Los nonces de "Re-extraer" y "Generar nuevo resumen" crean entradas nuevas: limitar la caché
+@st.cache_data(show_spinner=False, max_entries=16)
+def extract_pcap_all_fields(_model, doc_hash, nonce, _text):
+    """Extrae todos los campos del PCAP con una sola llamada estructurada por chunk."""
+    structured_model = _model.with_structured_output(PCAPDatos)
+    system_message = SystemMessage(content=PCAP_EXTRACTION_PROMPT.format(campos="todos los campos del esquema"))
+    values = dict.fromkeys(PCAP_FIELDS)
+    for chunk in split_text(_text):
+        user_message = HumanMessage(content=f"Texto del documento:\n{chunk}")
+        result = structured_model.invoke([system_message, user_message])
+        for field in PCAP_FIELDS:
+            values[field] = merge_field_values(values[field], getattr(result, field))
+    return {field: value.model_dump() for field, value in values.items()}
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def extract_pcap_field(_model, doc_hash, field, nonce, _text):
+    """Vuelve a extraer un único campo tipado del PCAP (pulsación de "Re-extraer")."""
+    title, schema = PCAP_FIELDS[field]
+    structured_model = _model.with_structured_output(schema)
+    system_message = SystemMessage(content=PCAP_EXTRACTION_PROMPT.format(campos=f'únicamente el campo "{title}"'))
+    value = None
+    for chunk in split_text(_text):
+        user_message = HumanMessage(content=f"Texto del documento:\n{chunk}")
+        value = merge_field_values(value, structured_model.invoke([system_message, user_message]))
+    return value.model_dump()
+
+def extract_pcap_data(text, model):
+    """Extrae todos los campos estructurados del PCAP, reutilizando la caché de cada campo."""
+    doc_hash = document_hash(text)
+    extraction_key = (doc_hash, st.session_state.pcap_document_nonce)
+    # st.cache_data no guarda errores: no repetir una extracción fallida en cada rerun
+    failed_key, error_message = st.session_state.pcap_extraction_error or (None, None)
+    if failed_key == extraction_key:
+        st.error(error_message)
+        return None
+    try:
+        all_fields = extract_pcap_all_fields(model, doc_hash, st.session_state.pcap_document_nonce, text)
+    except Exception as e:
+        error_message = f"Error al extraer los campos del PCAP: {str(e)}. Pulsa «Generar nuevo resumen» para reintentar."
+        st.session_state.pcap_extraction_error = (extraction_key, error_message)
+        st.error(error_message)
+        return None
+
+    pcap_data = dict(all_fields)
+    for field, (title, _) in PCAP_FIELDS.items():
+        nonce = st.session_state.pcap_field_nonces[field]
+        if nonce is None:
+            continue
+        try:
+            pcap_data[field] = extract_pcap_field(model, doc_hash, field, nonce, text)
+        except Exception as e:
+            # Volver al valor de la extracción conjunta para no reintentar en cada rerun
+            st.session_state.pcap_field_nonces[field] = None
+            st.error(f"Error al volver a extraer el campo {title}: {str(e)}")
+    return pcap_data
+
+def reset_pcap_nonces(document_nonce=None):
+    """Vuelve a servir todos los campos desde la extracción conjunta del documento."""
+    st.session_state.pcap_field_nonces = dict.fromkeys(PCAP_FIELDS)
+    st.session_state.pcap_document_nonce = document_nonce
+
+# Búsqueda léxica local para el chat de preguntas sobre los pliegos
+TOKEN_PATTERN = re.compile(r"\w+")
+STOPWORDS = {
+    "a", "al", "como", "con", "cual", "cuál", "de", "del", "el", "en", "es", "esta", "este", "la", "las",
+    "lo", "los", "o", "para", "por", "que", "se", "su", "sus", "un", "una", "y",
+}
+CHAT_TOP_K = 5
+CHAT_HISTORY_MESSAGES = 4
+
+def tokenize(text):
+    """Normaliza el texto (minúsculas y sin tildes) y lo divide en términos de búsqueda."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return [token for token in TOKEN_PATTERN.findall(text) if token not in STOPWORDS]
+
+def split_passages(text, passage_size=150, overlap=30):
+    """Divide el texto en fragmentos solapados de unas pocas decenas de palabras."""
+    words = text.split()
+    step = passage_size - overlap
+    return [" ".join(words[start:start + passage_size]) for start in range(0, max(len(words) - overlap, 1), step)]
+
+class BM25Index:
+    """Índice BM25 en memoria sobre los fragmentos de un documento."""
+
+    def __init__(self, passages, k1=1.5, b=0.75):
+        self.passages = passages
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(list)
+        self.lengths = []
+        for i, passage in enumerate(passages):
+            term_freqs = Counter(tokenize(passage))
+            self.lengths.append(sum(term_freqs.values()))
+            for term, freq in term_freqs.items():
+                self.postings[term].append((i, freq))
+        self.avg_length = sum(self.lengths) / len(passages) if passages else 0
+        self.idf = {
+            term: math.log(1 + (len(passages) - len(posting) + 0.5) / (len(posting) + 0.5))
+            for term, posting in self.postings.items()
+        }
+
+    def search(self, query, k=CHAT_TOP_K):
+        """Devuelve los k fragmentos más relevantes como pares (fragmento, puntuación)."""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            for i, freq in self.postings.get(term, []):
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+                scores[i] += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.passages[i], score) for i, score in best]
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def build_retrieval_index(doc_hash, _text):
+    """Construye (una sola vez por documento) el índice de búsqueda sobre su texto."""
+    return BM25Index(split_passages(_text))
+
+def retrieve_passages(question, k=CHAT_TOP_K):
+    """Busca los fragmentos más relevantes para la pregunta en los documentos cargados."""
+    results = []
+    for doc_type, text in st.session_state.processed_files.items():
+        if text:
+            index = build_retrieval_index(document_hash(text), text)
+            results.extend((score, doc_type, passage) for passage, score in index.search(question, k))
+    return sorted(results, key=lambda result: result[0], reverse=True)[:k]
+
+def stream_chat_answer(question, passages, history, model):
+    """Genera en streaming la respuesta usando solo los fragmentos recuperados y el historial reciente."""
+    system_message = SystemMessage(
+        content="""Eres Solutia, una asistente experta en pliegos de licitaciones públicas (PPT y PCAP).
+Responde a la pregunta en español utilizando únicamente los fragmentos de los pliegos proporcionados.
+Indica de qué documento (PPT o PCAP) procede cada dato.
+Si la respuesta no aparece en los fragmentos, indícalo claramente en lugar de suponerla."""
+    )
+    messages = [system_message]
+    for message in history[-CHAT_HISTORY_MESSAGES:]:
+        message_class = HumanMessage if message["role"] == "user" else AIMessage
+        messages.append(message_class(content=message["content"]))
+    context = "\n\n".join(f"[{doc_type.upper()}] {passage}" for _, doc_type, passage in passages)
+    messages.append(HumanMessage(content=f"Fragmentos relevantes:\n{context}\n\nPregunta: {question}"))
+    for chunk in model.stream(messages):
+        yield chunk.content
+
 # Función para validar el nombre del archivo
 def validate_file_type(filename, expected_type):
     return expected_type.lower() in filename.lower()
@@ -299,19 +842,28 @@ ppt_file = st.file_uploader(
 if not ppt_file:
     if st.session_state.processed_files["ppt"] is not None:
         st.session_state.processed_files["ppt"] = None
+        st.session_state.chat_history = []
         st.session_state.processed_summaries["ppt"] = None
 elif ppt_file and validate_file_type(ppt_file.name, "ppt"):
     with st.spinner("Procesando PPT..."):
         ppt_text = extract_text_with_langchain(ppt_file)
         if ppt_text:
+            if st.session_state.processed_files["ppt"] not in (None, ppt_text):
+                # Las respuestas anteriores se refieren al PPT sustituido
+                st.session_state.chat_history = []
             st.session_state.processed_files["ppt"] = ppt_text
             if "ppt" not in st.session_state.display_order:
-                ppt_summary = process_full_document(ppt_text, llm, task="Resumen de PPT")
+                preview = st.empty()
+                show_key_figures_preview(preview, ppt_text)
+                ppt_summary, st.session_state.summary_stats["ppt"] = summarize_document(ppt_text, llm, task="Resumen de PPT")
+                preview.empty()
                 st.session_state.processed_summaries["ppt"] = ppt_summary
                 st.session_state.display_order.insert(0, "ppt")
             st.success(f"PPT procesado correctamente: {ppt_file.name}")
 else:
     st.error("El archivo subido no parece ser un PPT. Por favor, verifica el nombre del archivo.")
+    if st.session_state.processed_files["ppt"] is not None:
+        st.session_state.chat_history = []
     st.session_state.processed_files["ppt"] = None
 
 # Subir PCAP
@@ -323,29 +875,100 @@ pcap_file = st.file_uploader(
     help="Arrastra o selecciona tu archivo PCAP aquí - Límite 200MB por archivo • PDF"
 )
 
+structured_pcap = st.checkbox(
+    "Extracción estructurada de campos del PCAP",
+    key="pcap_structured",
+    help="Extrae los campos clave del PCAP como datos tipados, cacheados campo a campo"
+)
+
 # Verificar si el archivo fue removido
 if not pcap_file:
     if st.session_state.processed_files["pcap"] is not None:
         st.session_state.processed_files["pcap"] = None
+        st.session_state.chat_history = []
         st.session_state.processed_summaries["pcap"] = None
+        st.session_state.processed_data["pcap"] = None
+        reset_pcap_nonces()
 elif pcap_file and validate_file_type(pcap_file.name, "pcap"):
     with st.spinner("Procesando PCAP..."):
         pcap_text = extract_text_with_langchain(pcap_file)
         if pcap_text:
+            if st.session_state.processed_files["pcap"] not in (None, pcap_text):
+                # Las respuestas anteriores se refieren al PCAP sustituido
+                st.session_state.chat_history = []
+            if st.session_state.processed_files["pcap"] != pcap_text:
+                # Documento nuevo o sustituido: partir de la extracción conjunta
+                reset_pcap_nonces()
+                st.session_state.processed_data["pcap"] = None
+                st.session_state.processed_summaries["pcap"] = None
             st.session_state.processed_files["pcap"] = pcap_text
-            if "pcap" not in st.session_state.display_order:
-                pcap_summary = process_full_document(pcap_text, llm, task="Resumen de PCAP")
+            preview = st.empty()
+            if structured_pcap:
+                if st.session_state.processed_data["pcap"] is None:
+                    show_key_figures_preview(preview, pcap_text)
+                # Cada campo se sirve desde caché salvo que se haya pedido re-extraerlo
+                st.session_state.processed_data["pcap"] = extract_pcap_data(pcap_text, llm)
+            elif st.session_state.processed_summaries["pcap"] is None:
+                show_key_figures_preview(preview, pcap_text)
+                pcap_summary, st.session_state.summary_stats["pcap"] = summarize_document(pcap_text, llm, task="Resumen de PCAP")
                 st.session_state.processed_summaries["pcap"] = pcap_summary
+            preview.empty()
+            if "pcap" not in st.session_state.display_order:
                 st.session_state.display_order.insert(0, "pcap")
             st.success(f"PCAP procesado correctamente: {pcap_file.name}")
 else:
     st.error("El archivo subido no parece ser un PCAP. Por favor, verifica el nombre del archivo.")
+    if st.session_state.processed_files["pcap"] is not None:
+        st.session_state.chat_history = []
     st.session_state.processed_files["pcap"] = None
 
+def show_pcap_data():
+    pcap_data = st.session_state.processed_data["pcap"]
+    if not pcap_data:
+        return
+    st.markdown("### Resumen PCAP")
+    for field, (title, _) in PCAP_FIELDS.items():
+        st.markdown(f"#### {title}")
+        value = pcap_data.get(field)
+        headers, rows = pcap_field_table(field, value) if value else ([], [])
+        if rows:
+            st.table([dict(zip(headers, row)) for row in rows])
+        else:
+            st.info("No se encontró información en el documento.")
+        if st.button("Re-extraer", key=f"reextract_{field}"):
+            st.session_state.pcap_field_nonces[field] = uuid.uuid4().hex
+            st.rerun()
+    doc_path = create_word_document_from_pcap_data(pcap_data)
+    with open(doc_path, "rb") as file:
+        st.download_button(
+            label="Descargar resumen PCAP en Word",
+            data=file,
+            file_name="resumen_pcap.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            key="download_pcap_data"
+        )
+    os.remove(doc_path)
+
+def show_summary_stats(stats):
+    """Muestra el tamaño de la fase map y de la entrada del resumen final de este documento."""
+    if not stats:
+        return
+    budget = f" de un límite de {stats['map_budget_tokens']}" if stats["map_budget_tokens"] else ""
+    reduction = 1 - stats["notes_tokens"] / stats["map_output_tokens"] if stats["map_output_tokens"] else 0
+    st.caption(
+        f"Fase map: {stats['chunks']} partes · ≈{stats['map_output_tokens']} tokens de salida{budget} · "
+        f"notas deduplicadas ≈{stats['notes_tokens']} tokens (−{reduction:.0%}), "
+        f"{stats['unformatted_notes']} líneas sin formato conservadas · "
+        f"entrada del resumen final ≈{stats['reduce_input_tokens']} tokens"
+    )
+
 def show_summary(doc_type):
-    if st.session_state.processed_summaries[doc_type]:
+    if doc_type == "pcap" and st.session_state.pcap_structured:
+        show_pcap_data()
+    elif st.session_state.processed_summaries[doc_type]:
         st.markdown(f"### Resumen {doc_type.upper()}")
         st.markdown(st.session_state.processed_summaries[doc_type], unsafe_allow_html=True)
+        show_summary_stats(st.session_state.summary_stats[doc_type])
         doc_path = create_word_document_with_clean_formatting(st.session_state.processed_summaries[doc_type])
         with open(doc_path, "rb") as file:
             st.download_button(
@@ -363,21 +986,27 @@ with summary_container:
     for doc_type in st.session_state.display_order:
         show_summary(doc_type)
 
+# Contadores de resúmenes compartidos entre sesiones
+summary_flights = get_summary_flights()
+with st.sidebar:
+    st.markdown("### Resúmenes compartidos")
+    st.metric("Resúmenes generados", summary_flights.jobs_started)
+    st.metric("Peticiones agrupadas", summary_flights.jobs_joined)
+    st.metric("Llamadas al modelo ahorradas", summary_flights.calls_saved)
+
 # Modificar el botón de generar nuevo resumen
 if st.button("Generar nuevo resumen"):
     current_type = st.session_state.display_order[0] if st.session_state.display_order else None
     
-    if current_type:
+    if current_type == "pcap" and st.session_state.pcap_structured:
+        # Invalidar la caché de todos los campos para forzar una nueva extracción
+        reset_pcap_nonces(uuid.uuid4().hex)
+        st.session_state.display_order = [current_type]
+        st.rerun()
+    elif current_type:
         with st.spinner(f"Regenerando resumen {current_type.upper()}..."):
-            # Limpiar el archivo Word anterior si existe
-            if os.path.exists("resumen_generado.docx"):
-                try:
-                    os.remove("resumen_generado.docx")
-                except:
-                    pass
-            
             # Generar nuevo resumen
-            new_summary = process_full_document(
+            new_summary, st.session_state.summary_stats[current_type] = summarize_document(
                 st.session_state.processed_files[current_type],
                 llm,
                 task=f"Resumen de {current_type.upper()}"
@@ -392,3 +1021,26 @@ if st.button("Generar nuevo resumen"):
             st.success(f"Resumen {current_type.upper()} regenerado")
             st.rerun()
 
+# Chat de preguntas sobre los pliegos cargados
+if any(st.session_state.processed_files.values()):
+    st.markdown("### Pregunta sobre los pliegos")
+    for message in st.session_state.chat_history:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+    question = st.chat_input("Pregunta sobre el PPT o el PCAP, p. ej. ¿cuál es la garantía definitiva?")
+    if question:
+        with st.chat_message("user"):
+            st.markdown(question)
+        passages = retrieve_passages(question)
+        with st.chat_message("assistant"):
+            try:
+                answer = st.write_stream(
+                    stream_chat_answer(question, passages, st.session_state.chat_history, llm)
+                )
+            except Exception as e:
+                st.error(f"Error al generar la respuesta: {str(e)}")
+                answer = None
+        if answer:
+            st.session_state.chat_history.append({"role": "user", "content": question})
+            st.session_state.chat_history.append({"role": "assistant", "content": answer})
@@ -0,0 +1,298 @@
+"""Prueba de carga multisesión de la app de Streamlit (src/chatbot.py).
+
+Lanza N sesiones simuladas con AppTest que suben los PDF de PPT y PCAP indicados,
+esperan a los resúmenes y generan los Word de descarga. ChatOpenAI se sustituye
+por un modelo local que solo simula latencia, de modo que no se hacen llamadas a OpenAI.
+
+En modo "distinct" cada sesión recibe un documento con texto diferente, de modo que
+la agrupación de resúmenes en curso (SingleFlight) no comparte trabajo entre sesiones
+y se mide la capacidad para N analistas independientes. En modo "shared" todas las
+sesiones suben el mismo documento y se mide el efecto de esa agrupación.
+
+Uso:
+    python tools/load_test.py --ppt fixtures/ppt.pdf --pcap fixtures/pcap.pdf --concurrency 1,2,4,8
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import langchain.document_loaders
+import langchain_openai
+import streamlit
+from langchain_community.document_loaders import PyPDFium2Loader
+from langchain_core.messages import AIMessage, AIMessageChunk
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = Path(__file__).resolve().parent.parent / "src" / "chatbot.py"
+SALT_MARKER = b"\n%load-test-salt:"
+SALT_STATE_KEY = "_load_test_salt"
+
+FAKE_SUMMARY = """## Resumen simulado
+
+| Campo | Valor |
+|---|---|
+| Presupuesto base de licitación | 100.000,00 € |
+| Plazo de ejecución | 12 meses |
+
+Texto generado por el modelo local de la prueba de carga."""
+
+
+class LatencyChatModel:
+    """Sustituto local de ChatOpenAI que simula la latencia del modelo sin llamadas de red."""
+
+    latency = 1.0
+    jitter = 0.2
+    tokens_per_second = 60.0
+    output_tokens = 300
+
+    def __init__(self, model="gpt-4o-mini", **kwargs):
+        self.model_name = model
+
+    def _wait(self):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)) + self.output_tokens / self.tokens_per_second)
+
+    def invoke(self, messages, **kwargs):
+        self._wait()
+        return AIMessage(content=FAKE_SUMMARY)
+
+    def __call__(self, messages, **kwargs):
+        return self.invoke(messages, **kwargs)
+
+    def stream(self, messages, **kwargs):
+        self._wait()
+        for word in FAKE_SUMMARY.split(" "):
+            yield AIMessageChunk(content=word + " ")
+
+    def bind(self, **kwargs):
+        return self
+
+    def with_structured_output(self, schema, **kwargs):
+        return StructuredStandIn(self, schema)
+
+
+class StructuredStandIn:
+    """Salida estructurada simulada: devuelve el esquema vacío tras la latencia del modelo."""
+
+    def __init__(self, model, schema):
+        self.model = model
+        self.schema = schema
+
+    def invoke(self, messages, **kwargs):
+        self.model._wait()
+        return self.schema()
+
+
+class FixtureUpload(io.BytesIO):
+    """Archivo subido simulado con la misma interfaz que usa la app (name y getvalue).
+
+    Con salt, se añade un comentario tras el final del PDF que SaltedPDFLoader incorpora al texto.
+    """
+
+    def __init__(self, path, doc_type, salt=None):
+        data = path.read_bytes()
+        if salt:
+            data += SALT_MARKER + salt.encode() + b"\n"
+        super().__init__(data)
+        # La app valida el tipo de documento por el nombre del archivo
+        self.name = path.name if doc_type in path.name.lower() else f"{doc_type}_{path.name}"
+
+
+class SaltedPDFLoader(PyPDFium2Loader):
+    """Cargador de PDF que añade a la última página la sal de sesión escrita por FixtureUpload."""
+
+    def load(self):
+        documents = super().load()
+        _, found, salt = Path(self.file_path).read_bytes().rpartition(SALT_MARKER)
+        if found and documents:
+            documents[-1].page_content += f"\nsesión de carga {salt.decode().strip()}"
+        return documents
+
+
+def install_stand_ins(fixtures):
+    """Sustituye ChatOpenAI, el cargador de PDF y st.file_uploader para que las sesiones no dependan de red ni navegador."""
+    langchain_openai.ChatOpenAI = LatencyChatModel
+    langchain.document_loaders.PyPDFium2Loader = SaltedPDFLoader
+
+    def file_uploader(label, type=None, key=None, **kwargs):
+        doc_type = key.replace("_uploader", "") if key else None
+        path = fixtures.get(doc_type)
+        salt = streamlit.session_state.get(SALT_STATE_KEY)
+        return FixtureUpload(path, doc_type, salt) if path else None
+
+    streamlit.file_uploader = file_uploader
+
+
+def current_rss_mb():
+    """Memoria residente actual del proceso en MB (pico histórico si /proc no está disponible)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MemorySampler(threading.Thread):
+    """Registra el pico de memoria residente mientras dura un nivel de concurrencia."""
+
+    def __init__(self, interval=0.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_mb = current_rss_mb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_session(timeout, expected_downloads, distinct):
+    """Ejecuta una sesión completa y devuelve (latencia en segundos, error o None, AppTest)."""
+    app = AppTest.from_file(str(APP_PATH), default_timeout=timeout)
+    if distinct:
+        app.session_state[SALT_STATE_KEY] = uuid.uuid4().hex
+    start = time.perf_counter()
+    try:
+        app.run()
+    except Exception as e:
+        return time.perf_counter() - start, str(e), None
+    latency = time.perf_counter() - start
+    if app.exception:
+        return latency, app.exception[0].value, app
+    downloads = len(app.get("download_button"))
+    if downloads < expected_downloads:
+        return latency, f"{downloads}/{expected_downloads} descargas Word generadas", app
+    return latency, None, app
+
+
+def percentile(values, pct):
+    """Percentil por rango más cercano."""
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def read_flight_counters(app):
+    """Lee los contadores acumulados de resúmenes compartidos de la barra lateral."""
+    return {metric.label: int(metric.value) for metric in app.sidebar.get("metric")}
+
+
+def run_level(mode, concurrency, sessions, timeout, expected_downloads, previous_flights):
+    """Lanza las sesiones con la concurrencia indicada y resume latencias, throughput y memoria."""
+    sampler = MemorySampler()
+    sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda _: run_session(timeout, expected_downloads, mode == "distinct"), range(sessions)
+        ))
+    elapsed = time.perf_counter() - start
+    sampler.stop()
+
+    latencies = [latency for latency, error, _ in results if error is None]
+    errors = [error for _, error, _ in results if error is not None]
+    # Los contadores son globales del proceso: restar los del nivel anterior
+    flights = dict(previous_flights)
+    apps = [app for _, _, app in results if app is not None]
+    if apps:
+        flights = read_flight_counters(apps[-1])
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "sessions": sessions,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50": percentile(latencies, 50) if latencies else None,
+        "p95": percentile(latencies, 95) if latencies else None,
+        "p99": percentile(latencies, 99) if latencies else None,
+        "mean": statistics.mean(latencies) if latencies else None,
+        "throughput": len(latencies) / elapsed,
+        "peak_rss_mb": sampler.peak_mb,
+        "single_flight": {label: value - previous_flights.get(label, 0) for label, value in flights.items()},
+        "single_flight_total": flights,
+    }
+
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.2f}s"
+
+
+def print_report(levels):
+    print(f"{'modo':>8} {'conc':>5} {'ses':>5} {'err':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'ses/s':>7} {'RSS MB':>8}")
+    for level in levels:
+        print(
+            f"{level['mode']:>8} {level['concurrency']:>5} {level['sessions']:>5} {level['errors']:>4} "
+            f"{format_seconds(level['p50']):>8} {format_seconds(level['p95']):>8} {format_seconds(level['p99']):>8} "
+            f"{level['throughput']:>7.2f} {level['peak_rss_mb']:>8.1f}"
+        )
+        if level["single_flight"]:
+            counters = ", ".join(f"{label}: {value}" for label, value in level["single_flight"].items())
+            print(f"         resúmenes compartidos: {counters}")
+        if level["first_error"]:
+            print(f"         primer error: {level['first_error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga multisesión de src/chatbot.py")
+    parser.add_argument("--ppt", type=Path, help="PDF de PPT que suben las sesiones")
+    parser.add_argument("--pcap", type=Path, help="PDF de PCAP que suben las sesiones")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="Niveles de concurrencia separados por comas")
+    parser.add_argument("--sessions", type=int, default=None, help="Sesiones por nivel (por defecto, 2 x concurrencia)")
+    parser.add_argument("--latency", type=float, default=1.0, help="Latencia base simulada por llamada al modelo (s)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Desviación típica de la latencia simulada (s)")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0, help="Velocidad de generación simulada")
+    parser.add_argument("--output-tokens", type=int, default=300, help="Tokens de salida simulados por llamada")
+    parser.add_argument(
+        "--coalescing", choices=["distinct", "shared", "both"], default="both",
+        help="distinct: documento distinto por sesión (sin trabajo compartido); shared: mismo documento; both: ambos",
+    )
+    parser.add_argument("--timeout", type=float, default=600.0, help="Tiempo máximo por sesión (s)")
+    parser.add_argument("--json", type=Path, help="Guardar también los resultados en este archivo JSON")
+    args = parser.parse_args(argv)
+
+    fixtures = {"ppt": args.ppt, "pcap": args.pcap}
+    if not any(fixtures.values()):
+        parser.error("Indica al menos un PDF con --ppt o --pcap")
+    for path in fixtures.values():
+        if path and not path.is_file():
+            parser.error(f"No existe el archivo {path}")
+
+    LatencyChatModel.latency = args.latency
+    LatencyChatModel.jitter = args.jitter
+    LatencyChatModel.tokens_per_second = args.tokens_per_second
+    LatencyChatModel.output_tokens = args.output_tokens
+    install_stand_ins(fixtures)
+
+    expected_downloads = sum(1 for path in fixtures.values() if path)
+    modes = ["distinct", "shared"] if args.coalescing == "both" else [args.coalescing]
+    levels = []
+    flights = {}
+    for mode in modes:
+        for concurrency in (int(value) for value in args.concurrency.split(",")):
+            sessions = args.sessions or 2 * concurrency
+            print(f"Ejecutando {sessions} sesiones ({mode}) con concurrencia {concurrency}...", file=sys.stderr)
+            level = run_level(mode, concurrency, sessions, args.timeout, expected_downloads, flights)
+            flights = level["single_flight_total"]
+            levels.append(level)
+
+    print_report(levels)
+    if args.json:
+        args.json.write_text(json.dumps(levels, indent=2, ensure_ascii=False), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()